@@ -0,0 +1,79 @@
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch as th
+from stable_baselines3.common.buffers import DictReplayBuffer
+from stable_baselines3.common.type_aliases import DictReplayBufferSamples
+from stable_baselines3.common.vec_env import VecNormalize
+
+
+class DeviceDictReplayBuffer(DictReplayBuffer):
+    """A `DictReplayBuffer` that keeps the observations on the policy device.
+
+    Observations are stored in their original dtype (`uint8` for the camera
+    images), so a gradient step only indexes device memory instead of copying
+    a batch of images from host RAM. Actions, rewards and dones stay on the host
+    as they are small.
+
+    Observation normalization through `VecNormalize` is not supported.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.observations = self._to_device_storage(self.observations)
+        self.next_observations = self._to_device_storage(self.next_observations)
+
+    def _to_device_storage(self, observations: Dict[str, np.ndarray]) -> Dict[str, th.Tensor]:
+        return {
+            key: th.zeros(obs.shape, dtype=th.from_numpy(np.empty(0, dtype=obs.dtype)).dtype, device=self.device)
+            for key, obs in observations.items()
+        }
+
+    def _store(self, storage: Dict[str, th.Tensor], obs: Dict[str, np.ndarray]) -> None:
+        for key, value in obs.items():
+            value = np.asarray(value).reshape((self.n_envs,) + self.obs_shape[key])
+            storage[key][self.pos].copy_(th.from_numpy(value))
+
+    def add(
+        self,
+        obs: Dict[str, np.ndarray],
+        next_obs: Dict[str, np.ndarray],
+        action: np.ndarray,
+        reward: np.ndarray,
+        done: np.ndarray,
+        infos: List[Dict[str, Any]],
+    ) -> None:
+        self._store(self.observations, obs)
+        self._store(self.next_observations, next_obs)
+
+        self.actions[self.pos] = np.array(action).reshape((self.n_envs, self.action_dim))
+        self.rewards[self.pos] = np.array(reward)
+        self.dones[self.pos] = np.array(done)
+
+        if self.handle_timeout_termination:
+            self.timeouts[self.pos] = np.array([info.get("TimeLimit.truncated", False) for info in infos])
+
+        self.pos += 1
+        if self.pos == self.buffer_size:
+            self.full = True
+            self.pos = 0
+
+    def _get_samples(
+        self,
+        batch_inds: np.ndarray,
+        env: Optional[VecNormalize] = None,
+    ) -> DictReplayBufferSamples:
+        env_indices = np.random.randint(0, high=self.n_envs, size=(len(batch_inds),))
+        batch_inds_ = th.as_tensor(batch_inds, device=self.device)
+        env_indices_ = th.as_tensor(env_indices, device=self.device)
+
+        return DictReplayBufferSamples(
+            observations={key: obs[batch_inds_, env_indices_] for key, obs in self.observations.items()},
+            actions=self.to_torch(self.actions[batch_inds, env_indices]),
+            next_observations={key: obs[batch_inds_, env_indices_] for key, obs in self.next_observations.items()},
+            # Only use dones that are not due to timeouts.
+            dones=self.to_torch(self.dones[batch_inds, env_indices] * (1 - self.timeouts[batch_inds, env_indices])).reshape(
+                -1, 1
+            ),
+            rewards=self.to_torch(self._normalize_reward(self.rewards[batch_inds, env_indices].reshape(-1, 1), env)),
+        )
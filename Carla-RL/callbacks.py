@@ -0,0 +1,63 @@
+import io
+import os
+import threading
+
+from stable_baselines3.common.callbacks import CheckpointCallback
+
+
+class AsyncCheckpointCallback(CheckpointCallback):
+    """A `CheckpointCallback` that writes the model checkpoints in the background.
+
+    The model is serialized into memory on the training thread, which gives a
+    consistent snapshot of the weights, and the bytes are written to disk by a
+    background thread while training goes on. If the previous write is still
+    running it is waited for, so no checkpoint is dropped.
+
+    The replay buffer is never part of the periodic checkpoints; with
+    `save_replay_buffer=True` it is saved once, when training ends.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._writer = None
+
+    def _write(self, path, data):
+        # The writer may be killed mid-write at interpreter exit, so the
+        # checkpoint only appears under its final name once complete.
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _wait_for_writer(self):
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def _on_step(self) -> bool:
+        if self.n_calls % self.save_freq == 0:
+            model_path = self._checkpoint_path(extension="zip")
+            buffer = io.BytesIO()
+            self.model.save(buffer)
+
+            self._wait_for_writer()
+            self._writer = threading.Thread(target=self._write, args=(model_path, buffer.getvalue()), daemon=True)
+            self._writer.start()
+            if self.verbose >= 2:
+                print(f"Saving model checkpoint to {model_path}")
+
+            if self.save_vecnormalize and self.model.get_vec_normalize_env() is not None:
+                vec_normalize_path = self._checkpoint_path("vecnormalize_", extension="pkl")
+                self.model.get_vec_normalize_env().save(vec_normalize_path)
+                if self.verbose >= 2:
+                    print(f"Saving model VecNormalize to {vec_normalize_path}")
+
+        return True
+
+    def _on_training_end(self) -> None:
+        self._wait_for_writer()
+        if self.save_replay_buffer and getattr(self.model, "replay_buffer", None) is not None:
+            replay_buffer_path = self._checkpoint_path("replay_buffer_", extension="pkl")
+            self.model.save_replay_buffer(replay_buffer_path)
+            if self.verbose >= 2:
+                print(f"Saving model replay buffer checkpoint to {replay_buffer_path}")
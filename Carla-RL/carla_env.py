@@ -5,26 +5,56 @@ import sys
 import carla
 import gym
 import time
-import random
 import numpy as np
 import math
+from dataclasses import dataclass
 from queue import Queue
-from threading import Event
+from threading import Event, Thread
 from misc import dist_to_roadline, exist_intersection
-from setup import setup
+from setup import release_server, setup
 from absl import logging
 import graphics
 import pygame
 logging.set_verbosity(logging.INFO)
 
+
+@dataclass(frozen=True)
+class EnvConfig:
+    """The `CarlaEnv` settings shared by every env of a run."""
+    __slots__ = ('town', 'fps', 'im_width', 'im_height', 'repeat_action', 'start_transform_type',
+                 'sensors', 'action_type', 'enable_preview', 'steps_per_episode')
+
+    town: str
+    fps: int
+    im_width: int
+    im_height: int
+    repeat_action: int
+    start_transform_type: str
+    sensors: tuple
+    action_type: str
+    enable_preview: bool
+    steps_per_episode: int
+
+    # The default slot unpickling assigns through the frozen `__setattr__`,
+    # which `SubprocVecEnv` workers hit when loading their env factory.
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+
 class CarlaEnv(gym.Env):
     metadata = {'render.modes': ['human']}
 
     def __init__(self, town, fps, im_width, im_height, repeat_action, start_transform_type, sensors,
-                 action_type, enable_preview, steps_per_episode, playing=False, timeout=60):
+                 action_type, enable_preview, steps_per_episode, playing=False, timeout=60, port=2000, gpu_id=0):
         super(CarlaEnv, self).__init__()
 
-        self.client, self.world, self.frame, self.server = setup(town=town, fps=fps, client_timeout=timeout)
+        self.client, self.world, self.frame, self.server = setup(
+            town=town, fps=fps, client_timeout=timeout, port=port, enable_preview=enable_preview,
+            gpu_id=gpu_id)
         self.client.set_timeout(5.0)
         self.map = self.world.get_map()
         blueprint_library = self.world.get_blueprint_library()
@@ -56,6 +86,13 @@ class CarlaEnv(gym.Env):
             # 'distant': gym.spaces.Box(low=0, high=1000, shape=(), dtype=np.float32)
         })
         
+    @classmethod
+    def from_config(cls, config, **kwargs):
+        """Returns a `CarlaEnv` built from an `EnvConfig`, `kwargs` go to `__init__`."""
+        return cls(config.town, config.fps, config.im_width, config.im_height, config.repeat_action,
+                   config.start_transform_type, config.sensors, config.action_type, config.enable_preview,
+                   config.steps_per_episode, **kwargs)
+
     #action space   
     @property
     def action_space(self):
@@ -70,8 +107,7 @@ class CarlaEnv(gym.Env):
     def seed(self, seed):
         if not seed:
             seed = 7
-        random.seed(seed)
-        self._np_random = np.random.RandomState(seed) 
+        self._np_random = np.random.default_rng(seed)
         return seed
 
     def reset(self):
@@ -244,10 +280,9 @@ class CarlaEnv(gym.Env):
         return obs, reward, done, info
     
     def close(self):
-        logging.info("Closes the CARLA server with process PID {}".format(self.server.pid))
+        logging.info("Releases the CARLA server with process PID {}".format(self.server.pid))
         self._destroy_agents()
-        os.system(f'taskkill /PID {server.pid} /F')
-        atexit.unregister(lambda: os.system(f'taskkill /PID {self.server.pid} /F'))
+        release_server(self.server)
     
     def render(self, mode='human'):
         if self.preview_camera_enabled:
@@ -257,8 +292,10 @@ class CarlaEnv(gym.Env):
                 render=(mode=="human"),
             )
 
-            preview_img = self.preview_image_Queue.get()
-            preview_img = np.array(preview_img.raw_data)
+            # `raw_data` does not keep the image alive, so `preview_image` is held
+            # until the dashboard has been drawn from the view.
+            preview_image = self.preview_image_Queue.get()
+            preview_img = np.frombuffer(preview_image.raw_data, dtype=np.uint8)
             preview_img = preview_img.reshape((400, 400, -1))
             preview_img = preview_img[:, :, :3]
             graphics.make_dashboard(
@@ -267,6 +304,7 @@ class CarlaEnv(gym.Env):
                 clock=self._clock,
                 observations={"preview_camera": preview_img},
             )
+            del preview_img, preview_image
 
             if mode == "human":
                 pygame.display.flip()
@@ -290,15 +328,15 @@ class CarlaEnv(gym.Env):
 
     def _get_start_transform(self):
         if self.start_transform_type == 'random':
-            return random.choice(self.map.get_spawn_points())
+            return self._random_spawn_point()
         if self.start_transform_type == 'fixed':
-            return random.choice(self.map.get_spawn_points())
+            return self._random_spawn_point()
             #start_transform = self.map.get_spawn_points()[70]
             return start_transform
         if self.start_transform_type == 'highway':
             if self.map.name == "Town04":
                 for trial in range(10):
-                    start_transform = random.choice(self.map.get_spawn_points())
+                    start_transform = self._random_spawn_point()
                     start_waypoint = self.map.get_waypoint(start_transform.location)
                     if start_waypoint.road_id in list(range(35, 50)): # TODO: change this
                         break
@@ -306,20 +344,26 @@ class CarlaEnv(gym.Env):
             else:
                 raise NotImplementedError
             
+    def _random_spawn_point(self):
+        spawn_points = self.map.get_spawn_points()
+        return spawn_points[self.np_random.integers(len(spawn_points))]
+
     def _get_end_transform(self):
-        return random.choice(self.map.get_spawn_points())
+        return self._random_spawn_point()
         #indices = [213, 215, 217, 71, 221, 224, 72, 87, 108]
         #end_transform = []
         #for i in indices:
             #end_transform.append(self.map.get_spawn_points()[i])
         #return random.choice(end_transform)
 
+    # `raw_data` is only valid while the callback runs, so the view is copied
+    # before the image goes back to CARLA's buffer pool.
     def _depth_callback(self, image):
-        self.depth_image = np.array(image.raw_data).reshape((self.im_width, self.im_height, -1))[:, :, :3]
+        self.depth_image = np.frombuffer(image.raw_data, dtype=np.uint8).reshape((self.im_width, self.im_height, -1))[:, :, :3].copy()
         self.depth_event.set()
 
     def _segmentation_callback(self, image):
-        self.segmentation_image = np.array(image.raw_data).reshape((self.im_width, self.im_height, -1))[:, :, :3]
+        self.segmentation_image = np.frombuffer(image.raw_data, dtype=np.uint8).reshape((self.im_width, self.im_height, -1))[:, :, :3].copy()
         self.segmentation_event.set()
 
     def get_observation(self):
@@ -336,8 +380,9 @@ class CarlaEnv(gym.Env):
         steer = control.steer
         distant = self.vehicle.get_location().distance(self.end_transform.location)
         
+        # Kept as uint8 up to the policy device, where it is normalized.
         combine_image = np.concatenate((self.depth_image, self.segmentation_image), axis = 2)
-        vehicle = np.array([speed,steer,distant])
+        vehicle = np.array([speed,steer,distant], dtype=np.float32)
         observation = {
             # 'depth_image': self.depth_image,
             # 'segmentation_image': self.segmentation_image,
@@ -348,3 +393,85 @@ class CarlaEnv(gym.Env):
             # 'distant': distant
         }
         return observation
+
+
+class PipelinedCarlaEnv(gym.Wrapper):
+    """Overlaps the policy forward pass with the `CARLA` tick.
+
+    `step` submits the action to a background thread that runs the wrapped
+    env's `step`, and returns the result of the previously submitted action
+    instead of waiting for the current one. Right after `reset` a priming
+    action (all zeros by default) keeps the pipeline one step ahead.
+
+    This turns the env into a delayed-action MDP and shifts credit
+    assignment by one step: the reward and next observation returned for
+    `a_t` are caused by `a_{t-1}`, `a_t` only affects the following step.
+    To keep the transitions Markov, the action in flight while the policy
+    picks the next one is appended to the observation under the
+    `pending_action` key.
+    """
+
+    def __init__(self, env, priming_action=None):
+        super(PipelinedCarlaEnv, self).__init__(env)
+        if priming_action is None:
+            priming_action = np.zeros(self.action_space.shape, dtype=self.action_space.dtype)
+        self.priming_action = priming_action
+        if isinstance(self.action_space, gym.spaces.Box):
+            low, high = self.action_space.low, self.action_space.high
+        else:  # MultiDiscrete
+            low, high = np.zeros_like(self.action_space.nvec), self.action_space.nvec - 1
+        self.observation_space = gym.spaces.Dict({
+            **env.observation_space.spaces,
+            'pending_action': gym.spaces.Box(
+                low=low.astype(np.float32), high=high.astype(np.float32), dtype=np.float32),
+        })
+        self._actions = Queue(maxsize=1)
+        self._results = Queue(maxsize=1)
+        self._pending = False
+        self._worker = Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while True:
+            action = self._actions.get()
+            if action is None:
+                return
+            try:
+                self._results.put(self.env.step(action))
+            except Exception as e:  # pylint: disable=broad-except
+                self._results.put(e)
+
+    def _submit(self, action):
+        self._actions.put(action)
+        self._pending = True
+
+    def _collect(self):
+        result = self._results.get()
+        self._pending = False
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def reset(self, **kwargs):
+        if self._pending:
+            self._collect()
+        obs = self.env.reset(**kwargs)
+        self._submit(self.priming_action)
+        return self._with_pending_action(obs, self.priming_action)
+
+    def step(self, action):
+        obs, reward, done, info = self._collect()
+        # The episode is over, the next action belongs to the one after `reset`.
+        if not done:
+            self._submit(action)
+        return self._with_pending_action(obs, action), reward, done, info
+
+    def _with_pending_action(self, obs, action):
+        return {**obs, 'pending_action': np.asarray(action, dtype=np.float32).reshape(-1)}
+
+    def close(self):
+        if self._pending:
+            self._collect()
+        self._actions.put(None)
+        self._worker.join()
+        self.env.close()
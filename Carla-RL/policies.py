@@ -0,0 +1,27 @@
+import warnings
+
+import torch as th
+from stable_baselines3.common.base_class import BaseAlgorithm
+
+
+def compile_policy(model: BaseAlgorithm, mode: str = "reduce-overhead") -> None:
+    """Compiles the SAC actor and critics with `torch.compile`.
+
+    The actor's `get_action_dist_params` is compiled since both `predict`
+    (through `forward`) and the training loss (through `action_log_prob`) go
+    through it; for the critics it is `forward`. Only these methods are
+    replaced, so the modules, their state dicts and SB3's save/load are
+    unchanged. Use `mode="default"` if CUDA graphs ("reduce-overhead")
+    misbehave, or `mode="none"` to disable it.
+
+    `torch.compile` needs PyTorch 2.0, the `torch==1.13.1` pinned in
+    requirements.txt does not have it and only gets a warning.
+    """
+    if mode == "none":
+        return
+    if not hasattr(th, "compile"):
+        warnings.warn(f"torch {th.__version__} has no torch.compile, the policy is not compiled")
+        return
+    model.actor.get_action_dist_params = th.compile(model.actor.get_action_dist_params, mode=mode)
+    for critic in (model.critic, model.critic_target):
+        critic.forward = th.compile(critic.forward, mode=mode)
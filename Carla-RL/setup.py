@@ -1,8 +1,9 @@
-import atexit
 import collections
+import multiprocessing.util
 import os
 import random
 import signal
+import socket
 import subprocess
 import sys
 import time
@@ -10,11 +11,258 @@ from typing import Any, List, Mapping, Optional, Sequence, Tuple, Union
 
 import carla
 import numpy as np
+import psutil
 import transforms3d.euler
 import logging
 
-# logging.set_verbosity(logging.DEBUG)
-logging.basicConfig(level=logging.DEBUG)
+if os.name == 'nt':  # Windows
+    import msvcrt
+else:  # Linux/Unix
+    import fcntl
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+# Set `CARLA_SETUP_DEBUG=1` to trace the server setup.
+if os.environ.get("CARLA_SETUP_DEBUG") == "1":
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(logging.StreamHandler())
+    # absl puts its own handler on the root logger, which would print every line again.
+    logger.propagate = False
+
+# The `CARLA` server launcher and the flags shared by every server.
+CARLA_ROOT = os.environ.get("CARLA_ROOT")
+_CARLA_BIN = os.path.join(CARLA_ROOT, "CarlaUE4.exe" if os.name == 'nt' else "CarlaUE4.sh") if CARLA_ROOT else None
+_COMMON_FLAGS = ["-opengl"]
+
+# CARLA reserves a block of `PORT_BLOCK` ports, the RPC port and the two
+# following ones for streaming, so servers running side by side are spread
+# `PORT_STRIDE` ports apart.
+PORT_STRIDE = 10
+PORT_BLOCK = 3
+
+# Servers outlive the program, to be reused by the next run, unless
+# `CARLA_KEEP_ALIVE=0`.
+KEEP_ALIVE = os.environ.get("CARLA_KEEP_ALIVE", "1") != "0"
+
+# The PID files of the running servers, one per RPC port.
+PID_DIR = os.path.join(os.path.expanduser("~"), ".cache", "carla_rl")
+
+# The handlers killing the tracked servers, keyed by server PID.
+_exit_handlers = {}
+
+# The held port lock files and the ports of the tracked servers, keyed by
+# port and server PID respectively.
+_port_locks = {}
+_server_ports = {}
+
+
+def _wait_for_server(port: int, timeout: float) -> bool:
+    """Polls the `CARLA` RPC port until it accepts connections.
+
+    Args:
+        port: The RPC port of the `CARLA` server.
+        timeout: The maximum time (in seconds) to wait for the server.
+
+    Returns:
+        True if the port accepted a connection before the timeout, False otherwise.
+    """
+    deadline = time.monotonic() + timeout
+    delay = 0.25
+    while time.monotonic() < deadline:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.settimeout(0.5)
+            if sock.connect_ex(("localhost", port)) == 0:
+                return True
+        time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+        delay = min(delay * 1.5, 2.0)
+    return False
+
+
+def _spawn_server(port: int, gpu: int, quality_level: str, enable_preview: bool) -> subprocess.Popen:
+    """Spawns a `CARLA` server process.
+
+    Args:
+        port: The RPC port of the `CARLA` server.
+        gpu: The index of the GPU used by the server for rendering.
+        quality_level: The `CARLA` rendering quality, `Low` or `Epic`.
+        enable_preview: If False the server renders off-screen without sound.
+
+    Returns:
+        The `CARLA` server process.
+
+    Raises:
+        EnvironmentError: If `CARLA_ROOT` is not set.
+    """
+    env = os.environ.copy()
+    env["SDL_VIDEODRIVER"] = "offscreen"
+    # Only `gpu` is visible to the server, where it is renumbered as device 0.
+    env["CUDA_VISIBLE_DEVICES"] = str(gpu)
+    env["SDL_HINT_CUDA_DEVICE"] = "0"
+    if _CARLA_BIN is None:
+        raise EnvironmentError("CARLA_ROOT is not set, cannot spawn a CARLA server")
+    logger.debug("Inits a CARLA server at port=%s", port)
+    cmd = [_CARLA_BIN, *_COMMON_FLAGS, f"-carla-rpc-port={port}", f"-quality-level={quality_level}"]
+    if not enable_preview:
+        cmd += ["-RenderOffScreen", "-nosound"]
+
+    if os.name == 'nt':  # Windows
+        server = subprocess.Popen(
+            cmd, stdout=None, stderr=subprocess.STDOUT,
+            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP, env=env,
+        )
+    else:  # Linux/Unix
+        env["DISPLAY"] = ""
+        server = subprocess.Popen(
+            cmd, stdout=None, stderr=subprocess.STDOUT, start_new_session=True, env=env,
+        )
+
+    os.makedirs(PID_DIR, exist_ok=True)
+    with open(_pid_file(port), "w") as f:
+        f.write(str(server.pid))
+    _track_server(server, port)
+    return server
+
+
+def _pid_file(port: int) -> str:
+    return os.path.join(PID_DIR, f"port_{port}.pid")
+
+
+def _lock_port(port: int) -> bool:
+    """Takes the per-port lock so no other run attaches to the server at `port`.
+
+    The lock is released by `_unlock_port`, or by the OS when the process exits.
+
+    Returns:
+        True if the lock was taken, False if another process holds it.
+    """
+    os.makedirs(PID_DIR, exist_ok=True)
+    lock = open(os.path.join(PID_DIR, f"port_{port}.lock"), "a+")
+    try:
+        if os.name == 'nt':  # Windows
+            msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+        else:  # Linux/Unix
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return False
+    _port_locks[port] = lock
+    return True
+
+
+def _unlock_port(port: int) -> None:
+    lock = _port_locks.pop(port, None)
+    if lock is not None:
+        lock.close()
+
+
+def _track_server(server: Union[subprocess.Popen, psutil.Process], port: int) -> None:
+    """Registers the handler killing `server`, at exit too unless `KEEP_ALIVE`."""
+    # The server runs in its own process group, so killing the group also
+    # reaches the `CarlaUE4` binary started by the launcher script.
+    pgid = None if os.name == 'nt' else os.getpgid(server.pid)
+
+    def kill():
+        try:
+            if os.name == 'nt':  # Windows
+                server.send_signal(signal.CTRL_BREAK_EVENT)
+            else:  # Linux/Unix
+                os.killpg(pgid, signal.SIGKILL)
+        except (OSError, psutil.Error):
+            pass  # The server has already exited.
+        try:
+            os.remove(_pid_file(port))
+        except OSError:
+            pass
+
+    # Unlike `atexit` handlers, finalizers also run when a `SubprocVecEnv`
+    # worker exits, calling one runs `kill` once and unregisters it.
+    if not KEEP_ALIVE:
+        kill = multiprocessing.util.Finalize(None, kill, exitpriority=10)
+    _exit_handlers[server.pid] = kill
+    _server_ports[server.pid] = port
+
+
+def _find_server(port: int) -> Optional[psutil.Process]:
+    """Returns the server left running at `port` by a previous run, if any."""
+    try:
+        with open(_pid_file(port)) as f:
+            pid = int(f.read())
+    except (OSError, ValueError):
+        return None
+    # The PID may have been recycled, only adopt a `CARLA` server on this port.
+    try:
+        server = psutil.Process(pid)
+        cmdline = " ".join(server.cmdline())
+    except psutil.Error:
+        return None
+    if "CarlaUE4" not in cmdline or f"-carla-rpc-port={port}" not in cmdline:
+        return None
+    if not _wait_for_server(port, 1.0):
+        return None
+    _track_server(server, port)
+    return server
+
+
+def stop_server(server: Union[subprocess.Popen, psutil.Process]) -> None:
+    """Kills a `CARLA` server process tracked by this module and unlocks its port."""
+    kill = _exit_handlers.pop(server.pid, None)
+    if kill is not None:
+        kill()
+    _unlock_port(_server_ports.pop(server.pid, None))
+
+
+def release_server(server: Union[subprocess.Popen, psutil.Process]) -> None:
+    """Hands back a server at teardown, it is only killed if not `KEEP_ALIVE`."""
+    if not KEEP_ALIVE:
+        stop_server(server)
+    else:
+        _unlock_port(_server_ports.get(server.pid))
+
+
+def _connect(port: int, town: str, fps: int, client_timeout: float, adopted: bool = False):
+    """Connects a client to a running `CARLA` server and loads the `town`.
+
+    Args:
+        adopted: Whether the server was left running by a previous run, which
+        may have crashed without destroying its actors.
+
+    Raises:
+        RuntimeError: If the server does not respond within `client_timeout`.
+    """
+    logger.debug("Connects a CARLA client at port=%s", port)
+    # The client's RPC and streaming sockets are opened by LibCarla in C++, not
+    # through Python's `socket` module, so Nagle cannot be disabled from here
+    # (patching `socket.socket` would only affect `_wait_for_server`). Disabling
+    # it has to happen in the CARLA build, on the server side.
+    client = carla.Client("localhost", port)  # pylint: disable=no-member
+    client.set_timeout(client_timeout)
+    world = client.get_world()
+    # Reuses the loaded map when possible, `load_world` streams all level assets.
+    if world.get_map().name.endswith(town):
+        logger.debug("Reusing world: %s", town)
+        if world.get_weather() != carla.WeatherParameters.ClearNoon:  # pylint: disable=no-member
+            world.set_weather(carla.WeatherParameters.ClearNoon)  # pylint: disable=no-member
+        if adopted:
+            leftovers = [*world.get_actors().filter("vehicle.*"), *world.get_actors().filter("sensor.*")]
+            if leftovers:
+                logger.debug("Destroying %s leftover actors", len(leftovers))
+                client.apply_batch_sync([carla.command.DestroyActor(actor) for actor in leftovers])  # pylint: disable=no-member
+    else:
+        logger.debug("Loading world: %s", town)
+        client.load_world(map_name=town)
+        world = client.get_world()
+        world.set_weather(carla.WeatherParameters.ClearNoon)  # pylint: disable=no-member
+    frame = world.apply_settings(
+        carla.WorldSettings(  # pylint: disable=no-member
+            synchronous_mode=True,
+            fixed_delta_seconds=1.0 / fps,
+        ))
+    # Each version query is a blocking RPC, only pay for it when tracing.
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Server version: %s", client.get_server_version())
+        logger.debug("Client version: %s", client.get_client_version())
+    return client, world, frame
+
 
 def setup(
     town: str,
@@ -22,17 +270,33 @@ def setup(
     server_timestop: float = 30.0,
     client_timeout: float = 20.0,
     num_max_restarts: int = 10,
+    port: int = 2000,
+    enable_preview: bool = False,
+    quality_level: Optional[str] = None,
+    gpu_id: int = 0,
 ):
     """Returns the `CARLA` `server`, `client` and `world`.
 
+    A server left running at `port` by a previous run is reused instead of
+    spawning a new one, see `KEEP_ALIVE`. Ports locked by another running
+    program are skipped.
+
     Args:
         town: The `CARLA` town identifier.
         fps: The frequency (in Hz) of the simulation.
-        server_timestop: The time interval between spawing the server
-        and resuming program.
+        server_timestop: The maximum time to wait for a spawned server
+        to accept connections on its RPC port.
         client_timeout: The time interval before stopping
         the search for the carla server.
-        num_max_restarts: Number of attempts to connect to the server.
+        num_max_restarts: Number of attempts to connect to the server, capped at
+        `PORT_STRIDE // PORT_BLOCK`.
+        port: The RPC port of the first attempt, each restart moves `PORT_BLOCK`
+        ports up, past the streaming ports of the previous one.
+        enable_preview: Whether the server renders on-screen for previewing,
+        it renders off-screen for training otherwise.
+        quality_level: The `CARLA` rendering quality, defaults to `Epic`
+        when previewing and `Low` otherwise.
+        gpu_id: The index of the GPU used by the server for rendering.
 
     Returns:
         client: The `CARLA` client.
@@ -42,66 +306,48 @@ def setup(
     """
     assert town in ("Town01", "Town02", "Town03", "Town04", "Town05")
 
+    if quality_level is None:
+        quality_level = "Epic" if enable_preview else "Low"
+
     # The attempts counter.
     attempts = 0
+    base_port = port
+    # Keeps the port blocks of the restarts within `PORT_STRIDE` ports so they
+    # never reach the next env's server.
+    num_max_restarts = min(num_max_restarts, PORT_STRIDE // PORT_BLOCK)
 
     while attempts < num_max_restarts:
-        logging.debug("{} out of {} attempts to setup the CARLA simulator".format(
-            attempts + 1, num_max_restarts))
+        logger.debug("%s out of %s attempts to setup the CARLA simulator", attempts + 1, num_max_restarts)
 
-        # Random assignment of port.
-        port = 2000 + attempts
+        port = base_port + PORT_BLOCK * attempts
 
-        # Start CARLA server.
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "offscreen"
-        env["SDL_HINT_CUDA_DEVICE"] = "0"
-        logging.debug("Inits a CARLA server at port={}".format(port))
+        # Another run is already using the server at this port.
+        if not _lock_port(port):
+            logger.debug("CARLA port=%s is locked by another run", port)
+            attempts += 1
+            continue
 
-        if os.name == 'nt':  # Windows
-            server = subprocess.Popen(
-                str(os.path.join(os.environ.get("CARLA_ROOT"), "CarlaUE4.exe")) + f' -opengl ' + f' -carla-rpc-port={port}' + f" -quality-level=Epic ",
-                stdout=None, stderr=subprocess.STDOUT, creationflags=subprocess.CREATE_NEW_PROCESS_GROUP, env=env, shell=True
-            )
-            atexit.register(lambda: os.kill(server.pid, signal.SIGTERM))
-        else:  # Linux/Unix
-            server = subprocess.Popen(
-                f'DISPLAY= ' + str(os.path.join(os.environ.get("CARLA_ROOT"), "CarlaUE4.sh")) + f' -opengl ' + f' -carla-rpc-port={port}' + f" -quality-level=Epic ",
-                stdout=None, stderr=subprocess.STDOUT, preexec_fn=os.setsid, env=env, shell=True
-            )
-            atexit.register(os.killpg, server.pid, signal.SIGKILL)
+        # Reuse a CARLA server left running by a previous run, or start one.
+        server = _find_server(port)
+        adopted = server is not None
+        if adopted:
+            logger.debug("Reusing CARLA server at port=%s", port)
+        else:
+            server = _spawn_server(port, gpu_id, quality_level, enable_preview)
 
-        time.sleep(server_timestop)
+            if not _wait_for_server(port, server_timestop):
+                logger.debug("CARLA server at port=%s not ready after %ss", port, server_timestop)
 
         # Connect client.
-        logging.debug("Connects a CARLA client at port={}".format(port))
         try:
-            client = carla.Client("localhost", port)  # pylint: disable=no-member
-            client.set_timeout(client_timeout)
-            logging.debug("Loading world: {}".format(town))
-            client.load_world(map_name=town)
-            world = client.get_world()
-            world.set_weather(carla.WeatherParameters.ClearNoon)  # pylint: disable=no-member
-            frame = world.apply_settings(
-                carla.WorldSettings(  # pylint: disable=no-member
-                    synchronous_mode=True,
-                    fixed_delta_seconds=1.0 / fps,
-                ))
-            logging.debug("Server version: {}".format(client.get_server_version()))
-            logging.debug("Client version: {}".format(client.get_client_version()))
+            client, world, frame = _connect(port, town, fps, client_timeout, adopted=adopted)
             return client, world, frame, server
         except RuntimeError as msg:
-            logging.debug(msg)
+            logger.debug(msg)
             attempts += 1
-            logging.debug("Stopping CARLA server at port={}".format(port))
-            
-            if os.name == 'nt':  # Windows
-                os.kill(server.pid, signal.SIGTERM)
-            else:  # Linux/Unix
-                os.killpg(server.pid, signal.SIGKILL)
-                
-            atexit.unregister(lambda: os.kill(server.pid, signal.SIGTERM))
+            logger.debug("Stopping CARLA server at port=%s", port)
+            stop_server(server)
 
-    logging.debug(
-        "Failed to connect to CARLA after {} attempts".format(num_max_restarts))
+    logger.error("Failed to connect to CARLA after %s attempts", num_max_restarts)
     sys.exit()
+
@@ -1,47 +1,95 @@
 import gym
 import numpy as np
+import torch
 from stable_baselines3 import SAC
-from stable_baselines3.common.callbacks import CheckpointCallback
+from stable_baselines3.common.buffers import DictReplayBuffer
 from stable_baselines3.sac import CnnPolicy
 from stable_baselines3.sac import MultiInputPolicy
-from stable_baselines3.common.noise import NormalActionNoise
-from carla_env import CarlaEnv
+from stable_baselines3.common.utils import set_random_seed
+from stable_baselines3.common.noise import NormalActionNoise, VectorizedActionNoise
+from stable_baselines3.common.vec_env import DummyVecEnv, SubprocVecEnv, VecFrameStack
+from buffers import DeviceDictReplayBuffer
+from callbacks import AsyncCheckpointCallback
+from carla_env import CarlaEnv, EnvConfig, PipelinedCarlaEnv
+from policies import compile_policy
+from setup import PORT_STRIDE
 import sys
 import argparse
+import dataclasses
+import signal
 
 import gym
 from gym import spaces
 import numpy as np
 
+# Exploration noise on (throttle, steer).
+NOISE_MEAN = np.array([0.3, 0.0])
+NOISE_SIGMA = np.array([0.5, 0.1])
 
-def main(model_name, load_model, town, fps, im_width, im_height, repeat_action, start_transform_type, sensors, 
-         enable_preview, steps_per_episode, seed=7, action_type='continuous'):
+def main(model_name, load_model, config, seed=7, n_envs=1, n_stack=4, gpu_buffer=False, pipeline=False,
+         compile_mode='reduce-overhead'):
 
-    env = CarlaEnv(town, fps, im_width, im_height, repeat_action, start_transform_type, sensors,
-                   action_type, enable_preview, steps_per_episode, playing=False)
-    test_env = CarlaEnv(town, fps, im_width, im_height, repeat_action, start_transform_type, sensors,
-                   action_type, enable_preview=False, steps_per_episode=steps_per_episode, playing=True)
+    # Keeps the CARLA servers off the GPU the policy trains on when there is more than one.
+    server_gpu = 1 if torch.cuda.device_count() > 1 else 0
+
+    def make_env(port, enable_preview, playing):
+        env_config = dataclasses.replace(config, enable_preview=enable_preview)
+
+        def _init():
+            env = CarlaEnv.from_config(env_config, playing=playing, port=port, gpu_id=server_gpu)
+            # The test env is pipelined too, a pipelined policy expects the `pending_action`
+            # observation and the one-step action delay it was trained with.
+            return PipelinedCarlaEnv(env) if pipeline else env
+        return _init
+
+    # Each worker process spawns its own CARLA server, so the servers start up concurrently
+    # and the policy runs on a batch of `n_envs` stacked observations per step.
+    env = VecFrameStack(SubprocVecEnv([
+        make_env(2000 + PORT_STRIDE * i, config.enable_preview and i == 0, playing=False)
+        for i in range(n_envs)]), n_stack=n_stack)
+    test_env = VecFrameStack(DummyVecEnv([
+        make_env(2000 + PORT_STRIDE * n_envs, enable_preview=False, playing=True)]), n_stack=n_stack)
     
-    checkpoint_callback = CheckpointCallback(save_freq=10000, save_path='./logs/', name_prefix='sac_model')
+    # Seeds Python, NumPy and PyTorch once here, and each env through its own generator,
+    # instead of letting SAC reseed everything at construction. `VecEnv.seed` gives env `i`
+    # `seed + i`, so the test env starts past the training envs' seeds.
+    set_random_seed(seed, using_cuda=True)
+    env.seed(seed)
+    test_env.seed(seed + n_envs)
+
+    action_noise = VectorizedActionNoise(NormalActionNoise(mean=NOISE_MEAN, sigma=NOISE_SIGMA), n_envs=n_envs)
+
+    # Checkpoints are written to disk in the background so training does not stall on them.
+    checkpoint_callback = AsyncCheckpointCallback(save_freq=10000, save_path='./logs/', name_prefix='sac_model')
     
     try:
         if load_model:
             model = SAC.load(
                 model_name, 
                 env, 
-                action_noise=NormalActionNoise(mean=np.array([0.3, 0.0]), sigma=np.array([0.5, 0.1])))
+                action_noise=action_noise)
+            model.action_space.seed(seed)
+            compile_policy(model, compile_mode)
         else:
             model = SAC(
                 #CnnPolicy,
                 MultiInputPolicy, 
                 env,
                 verbose=2,
-                buffer_size=10000,
-                seed=seed, 
-                device='cuda', 
+                buffer_size=10000 * n_envs,
+                # Keeping the replay buffer on the GPU avoids copying a batch of images per gradient step.
+                replay_buffer_class=DeviceDictReplayBuffer if gpu_buffer else DictReplayBuffer,
+                # One gradient step per collected transition, run in bursts of 4 env steps
+                # so the learner GPU is busy while the CARLA servers tick.
+                train_freq=(4, "step"),
+                gradient_steps=4 * n_envs,
+                device='cuda:0', 
                 tensorboard_log='./sem_sac',
-                action_noise=NormalActionNoise(mean=np.array([0.3, 0]), sigma=np.array([0.5, 0.1]))
+                action_noise=action_noise
                 )
+            # The random warm-up actions are sampled from the action space.
+            model.action_space.seed(seed)
+            compile_policy(model, compile_mode)
             print(model.__dict__)
             model.learn(    
                 total_timesteps=20000000, 
@@ -59,7 +107,6 @@ def main(model_name, load_model, town, fps, im_width, im_height, repeat_action,
                 while not done:
                     action, _states = model.predict(obs)
                     obs, reward, done, info = test_env.step(action)
-                    test_env.render()
                     print(f"Reward: {reward}, Info: {info}")
                 
     finally:
@@ -67,6 +114,9 @@ def main(model_name, load_model, town, fps, im_width, im_height, repeat_action,
         test_env.close()
 
 if __name__ == "__main__":
+    # Turns SIGTERM into a normal exit so the envs are closed and the CARLA servers released.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('--model-name', help='name of model when saving')
     parser.add_argument('--load', type=bool, help='whether to load existing model')
@@ -80,20 +130,28 @@ if __name__ == "__main__":
     parser.add_argument('--preview', action='store_true', help='whether to enable preview camera')
     parser.add_argument('--episode-length', type=int, help='maximum number of steps per episode')
     parser.add_argument('--seed', type=int, default=7, help='random seed for initialization')
+    parser.add_argument('--num-envs', type=int, default=1, help='number of parallel carla envs (one server each)')
+    parser.add_argument('--frame-stack', type=int, default=4, help='number of consecutive observations stacked')
+    parser.add_argument('--gpu-buffer', action='store_true', help='whether to store the replay buffer observations on the GPU')
+    parser.add_argument('--pipeline', action='store_true', help='whether to overlap carla ticks with policy inference '
+                        '(rewards and observations lag the action by one step, the in-flight action is added to the observation); '
+                        'pass it with --load too for a model trained with it')
+    parser.add_argument('--compile-mode', type=str, default='reduce-overhead',
+                        help='torch.compile mode of the policy networks (needs torch>=2.0): [default, reduce-overhead, none]')
     
     args = parser.parse_args()
-    model_name = args.model_name
-    load_model = args.load
-    town = args.map
-    fps = args.fps
-    im_width = args.width
-    im_height = args.height
-    repeat_action = args.repeat_action
-    start_transform_type = args.start_location
-    sensors = args.sensor
-    enable_preview = args.preview
-    steps_per_episode = args.episode_length
-    seed = args.seed
+    config = EnvConfig(
+        town=args.map,
+        fps=args.fps,
+        im_width=args.width,
+        im_height=args.height,
+        repeat_action=args.repeat_action,
+        start_transform_type=args.start_location,
+        sensors=tuple(args.sensor or ()),
+        action_type='continuous',
+        enable_preview=args.preview,
+        steps_per_episode=args.episode_length,
+    )
 
-    main(model_name, load_model, town, fps, im_width, im_height, repeat_action, start_transform_type, sensors, 
-         enable_preview, steps_per_episode, seed)
\ No newline at end of file
+    main(args.model_name, args.load, config, args.seed, n_envs=args.num_envs, n_stack=args.frame_stack,
+         gpu_buffer=args.gpu_buffer, pipeline=args.pipeline, compile_mode=args.compile_mode)